@@ -1,8 +1,58 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
+import pyproj
+import shapely
 import argparse
-import math
+import hashlib
+import os
+from numba import njit
+
+
+@njit(cache=True, nogil=True)
+def _count_pairs(user_codes, item_codes, n_items):
+    """
+    Counts occurrences of each (user code, item code) pair, items being e.g. GEOID codes or day indices
+    in [0, n_items).
+
+    Returns:
+        tuple: User codes, item codes and counts of the distinct pairs, sorted by user code then item code.
+    """
+    keys = np.sort(user_codes * n_items + item_codes)
+    n_pairs = 0
+    for i in range(len(keys)):
+        if i == 0 or keys[i] != keys[i - 1]:
+            n_pairs += 1
+
+    pair_keys = np.empty(n_pairs, dtype=np.int64)
+    counts = np.zeros(n_pairs, dtype=np.int64)
+    j = -1
+    for i in range(len(keys)):
+        if i == 0 or keys[i] != keys[i - 1]:
+            j += 1
+            pair_keys[j] = keys[i]
+        counts[j] += 1
+    return pair_keys // n_items, pair_keys % n_items, counts
+
+
+@njit(cache=True, nogil=True)
+def _home_per_user(user_codes, visit_counts, min_visits, n_users):
+    """
+    Finds, for each user, the row with the most visits among rows meeting the user's minimum visits.
+    Ties keep the earliest row.
+
+    Returns:
+        ndarray: Row index of the home location for each user code, or -1 when the user has none.
+    """
+    best_row = -np.ones(n_users, dtype=np.int64)
+    best_count = np.zeros(n_users, dtype=np.int64)
+    for i in range(len(user_codes)):
+        u = user_codes[i]
+        if visit_counts[i] >= min_visits[u] and (best_row[u] < 0 or visit_counts[i] > best_count[u]):
+            best_row[u] = i
+            best_count[u] = visit_counts[i]
+    return best_row
+
 
 class HomeLocationIdentifier:
     """
@@ -11,92 +61,281 @@ class HomeLocationIdentifier:
     Attributes:
         input_file (str): Path to the input CSV file containing user data.
         shapefile (str): Path to the census tract shapefile.
-        output_file (str): Path to the output CSV file to save home location results.
+        output_file (str): Path to the output CSV (or .parquet) file to save home location results.
         start_hour (int): Start hour for defining nighttime (default is 22).
         end_hour (int): End hour for defining nighttime (default is 6).
+        grid_cell_size (float): Cell size, in meters, of the tract coverage grid used to drop points
+            that cannot fall inside any tract before the spatial join (default is 5000).
+        chunksize (int): Number of input rows read at a time; only nighttime rows of each chunk are kept.
+        verbose (bool): Whether to print diagnostics for each step (default is False).
+        cache_dir (str): Directory where the loaded nighttime data and spatial join results are cached,
+            keyed on the input files' modification times and the nighttime hours (default is None, no caching).
+        projected_crs (str): Projected CRS the tracts and locations are transformed to for the spatial join
+            (default is 'EPSG:5070', US Albers equal area, which is designed for the lower 48 states; use e.g.
+            'EPSG:3338' for Alaska only or 'EPSG:32161' for Puerto Rico only).
     """
     
-    def __init__(self, input_file, shapefile, output_file, start_hour=22, end_hour=6):
+    def __init__(self, input_file, shapefile, output_file, start_hour=22, end_hour=6, grid_cell_size=5000,
+                 chunksize=2_000_000, verbose=False, cache_dir=None, projected_crs='EPSG:5070'):
         """
         Initializes the HomeLocationIdentifier with file paths and nighttime hours.
         
         Args:
             input_file (str): Path to the input CSV file.
             shapefile (str): Path to the census tract shapefile.
-            output_file (str): Path to the output CSV file.
+            output_file (str): Path to the output CSV (or .parquet) file.
             start_hour (int, optional): Start hour for nighttime (default is 22).
             end_hour (int, optional): End hour for nighttime (default is 6).
+            grid_cell_size (float, optional): Cell size of the tract coverage grid in meters (default is 5000).
+            chunksize (int, optional): Number of input rows read per chunk (default is 2,000,000).
+            verbose (bool, optional): Whether to print diagnostics for each step (default is False).
+            cache_dir (str, optional): Directory for caching intermediate results (default is None, no caching).
+            projected_crs (str, optional): Projected CRS used for the spatial join (default is 'EPSG:5070').
         """
         self.input_file = input_file
         self.shapefile = shapefile
         self.output_file = output_file
         self.start_hour = start_hour
         self.end_hour = end_hour
-        self.df = None
+        self.grid_cell_size = grid_cell_size
+        self.chunksize = chunksize
+        self.verbose = verbose
+        self.cache_dir = cache_dir
+        self.input_dtypes = {'user_ID': str, 'unix_start_t': 'int64', 'orig_long': 'float64', 'orig_lat': 'float64'}
         self.tracts = None
+        self.projected_crs = projected_crs
+        self.xy_transformer = None
+        self.tract_tree = None
+        self.coverage_grid = None
+        self.grid_origin = None
         self.night_data = None
+        self.user_ids = None
         self.days_available = None
-        self.min_visits_table = pd.DataFrame({
-            'number_of_days': list(range(5, 22)),
-            'min_visits': [2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4]
-        })
+        self.number_of_days_by_user = None
+        self.min_visits_by_user = None
+        # Predefined min_visits indexed by number_of_days, for up to 21 days (fewer than 5 days map to 0)
+        self.min_visits_lut = np.zeros(22, dtype=np.int64)
+        self.min_visits_lut[5:22] = [2, 2, 2, 2, 2, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4]
+    
+    def cache_path(self, extension, *files, params=()):
+        """
+        Builds the cache file path for a stage whose result depends on the given files, the nighttime hours and
+        the given parameters.
+        
+        Args:
+            extension (str): Extension of the cache file.
+            *files (str): Paths of the files the stage reads.
+            params (tuple, optional): Other settings the stage's result depends on (default is none).
+        
+        Returns:
+            str: Path of the cache file, or None when caching is disabled.
+        """
+        if self.cache_dir is None:
+            return None
+        parts = []
+        for f in files:
+            parts += [f, str(os.path.getmtime(f))]
+        parts.append(f"{self.start_hour}-{self.end_hour}")
+        parts += [str(param) for param in params]
+        # A path cannot contain NUL, so NUL-separated fields give distinct keys for distinct inputs
+        key = '\0'.join(parts)
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode()).hexdigest() + extension)
     
     def load_data(self):
         """
-        Loads the input CSV file and census tract shapefile.
+        Loads the nighttime records of the input CSV file, from the cache when available.
+        """
+        path = self.cache_path('.parquet', self.input_file)
+        if path is not None and os.path.exists(path):
+            self.night_data = pd.read_parquet(path)
+            # Parquet only restores string categoricals; numeric user IDs come back as plain integers
+            self.night_data['user_ID'] = self.night_data['user_ID'].astype('category')
+        else:
+            self.night_data = self.read_night_data()
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self.night_data.to_parquet(path, index=False)
+        self.user_ids = self.night_data['user_ID'].cat.categories
+        if self.verbose:
+            print(f"Nighttime data contains {len(self.night_data)} records after filtering.")
+            print(f"Nighttime data contains {len(self.user_ids)} unique user IDs.")
+            print(f"First user IDs with nighttime data: {list(self.user_ids[:10])}")
+    
+    def read_night_data(self):
+        """
+        Reads the input CSV file in chunks, keeping only nighttime records that have a user ID.
+        
+        Returns:
+            DataFrame: The nighttime records, with a categorical user_ID column holding strings, or numbers when
+            every nighttime ID is numeric.
         """
-        self.df = pd.read_csv(self.input_file)
-        self.df['datetime'] = pd.to_datetime(self.df['unix_start_t'], unit='s')
-        self.tracts = gpd.read_file(self.shapefile)
-        print(f"Loaded data contains {self.df['user_ID'].nunique()} unique user IDs.")
+        chunks = []
+        loaded_user_ids = set()
+        reader = pd.read_csv(self.input_file, chunksize=self.chunksize, usecols=list(self.input_dtypes),
+                             dtype=self.input_dtypes)
+        for chunk in reader:
+            # Records without a user ID cannot be attributed to anyone (and would get a categorical code of -1)
+            chunk = chunk.dropna(subset=['user_ID'])
+            if self.verbose:
+                loaded_user_ids.update(chunk['user_ID'].unique())
+            chunks.append(self.filter_night_time_data(chunk))
+        if self.verbose:
+            print(f"Loaded data contains {len(loaded_user_ids)} unique user IDs.")
+        
+        night_data = pd.concat(chunks, ignore_index=True)
+        # Dictionary-encode user IDs once so downstream aggregations and lookups work on integer codes
+        user_id = night_data['user_ID'].astype('category')
+        
+        # IDs are read as strings so every chunk gets the same dtype; when all nighttime IDs are numeric, convert
+        # them as read_csv would have inferred, so they keep numeric values (007 becomes 7) and numeric ordering
+        numeric_ids = pd.to_numeric(user_id.cat.categories, errors='coerce')
+        if len(numeric_ids) and not numeric_ids.isna().any():
+            user_id = pd.Series(numeric_ids.to_numpy()[user_id.cat.codes.to_numpy()]).astype('category')
+        night_data['user_ID'] = user_id
+        return night_data
     
-    def filter_night_time_data(self):
+    def load_tracts(self):
+        """
+        Loads the census tract shapefile, reprojects it to the projected CRS and builds the tract STRtree and
+        coverage grid.
+        
+        Raises:
+            ValueError: If the shapefile has no CRS, since the locations could not be transformed alongside it.
+        """
+        tracts = gpd.read_file(self.shapefile)
+        if tracts.crs is None:
+            raise ValueError(f"Shapefile {self.shapefile} has no CRS (missing .prj file); assign one to the "
+                             f"shapefile, e.g. EPSG:4269 for census tracts, before identifying home locations.")
+        # Locations are given in the shapefile's geographic CRS; they are transformed alongside the tracts
+        self.xy_transformer = pyproj.Transformer.from_crs(tracts.crs, self.projected_crs, always_xy=True)
+        self.tracts = tracts.to_crs(self.projected_crs)
+        shapely.prepare(self.tracts.geometry.values)
+        self.tract_tree = shapely.STRtree(self.tracts.geometry.values)
+        self.build_coverage_grid()
+    
+    def build_coverage_grid(self):
+        """
+        Rasterizes the tract bounding boxes into a boolean grid marking every cell touched by a tract.
+        Points falling in unmarked cells cannot lie within any tract.
+        """
+        minx, miny, maxx, maxy = self.tracts.total_bounds
+        cell = self.grid_cell_size
+        n_cols = int((maxx - minx) // cell) + 1
+        n_rows = int((maxy - miny) // cell) + 1
+
+        bounds = self.tracts.bounds
+        c0 = ((bounds['minx'].to_numpy() - minx) // cell).astype(np.int64)
+        c1 = ((bounds['maxx'].to_numpy() - minx) // cell).astype(np.int64)
+        r0 = ((bounds['miny'].to_numpy() - miny) // cell).astype(np.int64)
+        r1 = ((bounds['maxy'].to_numpy() - miny) // cell).astype(np.int64)
+
+        # 2D difference array: mark each bounding box corner, then prefix-sum along both axes
+        diff = np.zeros((n_rows + 1, n_cols + 1), dtype=np.int32)
+        np.add.at(diff, (r0, c0), 1)
+        np.add.at(diff, (r0, c1 + 1), -1)
+        np.add.at(diff, (r1 + 1, c0), -1)
+        np.add.at(diff, (r1 + 1, c1 + 1), 1)
+        self.coverage_grid = diff.cumsum(axis=0).cumsum(axis=1)[:n_rows, :n_cols] > 0
+        self.grid_origin = (minx, miny)
+
+    def coverage_mask(self, x, y):
+        """
+        Looks up the coverage grid for each coordinate pair.
+
+        Args:
+            x (ndarray): Projected x coordinates of the points.
+            y (ndarray): Projected y coordinates of the points.
+
+        Returns:
+            ndarray: Boolean mask, True where the point falls in a cell covered by some tract.
+        """
+        minx, miny = self.grid_origin
+        n_rows, n_cols = self.coverage_grid.shape
+        with np.errstate(invalid='ignore'):
+            cols = np.floor((x - minx) / self.grid_cell_size)
+            rows = np.floor((y - miny) / self.grid_cell_size)
+        inside = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+        mask = np.zeros(len(x), dtype=bool)
+        mask[inside] = self.coverage_grid[rows[inside].astype(np.int64), cols[inside].astype(np.int64)]
+        return mask
+
+    def filter_night_time_data(self, df):
         """
         Filters the data to include only nighttime records based on specified hours.
+        
+        Args:
+            df (DataFrame): Records with a unix_start_t column.
+        
+        Returns:
+            DataFrame: The nighttime records.
         """
-        self.df['hour'] = self.df['datetime'].dt.hour
+        # Hour of day straight from the epoch seconds, without materializing datetimes
+        hour = (df['unix_start_t'].to_numpy(np.int64) // 3600) % 24
         if self.start_hour < self.end_hour:
-            self.night_data = self.df[(self.df['hour'] >= self.start_hour) & (self.df['hour'] < self.end_hour)]
-        else:
-            self.night_data = self.df[(self.df['hour'] >= self.start_hour) | (self.df['hour'] < self.end_hour)]
-        print(f"Nighttime data contains {len(self.night_data)} records after filtering.")
-        print(f"Nighttime data contains {self.night_data['user_ID'].nunique()} unique user IDs.")
-        print(f"User IDs with nighttime data: {self.night_data['user_ID'].unique()}")
+            return df[(hour >= self.start_hour) & (hour < self.end_hour)]
+        return df[(hour >= self.start_hour) | (hour < self.end_hour)]
     
     def calculate_days_available(self):
         """
         Calculates the number of days with nighttime data available for each user.
         """
-        self.night_data['date'] = self.night_data['datetime'].dt.date
-        self.days_available = self.night_data.groupby('user_ID')['date'].nunique().reset_index()
-        self.days_available.columns = ['user_ID', 'number_of_days']
+        # Day index (days since epoch) relative to the first night, computed without adding columns to night_data
+        date_int = self.night_data['unix_start_t'].to_numpy(np.int64) // 86400
+        if len(date_int):
+            date_int -= date_int.min()
         
-        # Merge with min_visits_table to get predefined values
-        self.days_available = self.days_available.merge(self.min_visits_table, on='number_of_days', how='left')
+        # Each distinct (user, day) pair is one day available for that user
+        pair_users, _, _ = _count_pairs(self.night_data['user_ID'].cat.codes.to_numpy(np.int64), date_int,
+                                        int(date_int.max()) + 1 if len(date_int) else 1)
+        # Dense per-user lookup arrays indexed by user code
+        self.number_of_days_by_user = np.bincount(pair_users, minlength=len(self.user_ids))
         
-        # Calculate min_visits for number_of_days greater than 21 using math.ceil for weeks
-        self.days_available['min_visits'] = self.days_available.apply(
-            lambda row: math.ceil(row['number_of_days'] / 7) if row['number_of_days'] > 21 else row['min_visits'],
-            axis=1
-        )
+        # Look up predefined min_visits, or use the ceiling of the number of weeks beyond 21 days
+        nd = self.number_of_days_by_user
+        self.min_visits_by_user = np.where(nd <= 21, self.min_visits_lut[np.clip(nd, 0, 21)], -(-nd // 7))
         
-        # Handle NaN values in min_visits
-        self.days_available['min_visits'] = self.days_available['min_visits'].fillna(0).astype(int)
+        self.days_available = pd.DataFrame({
+            'user_ID': pd.Categorical.from_codes(np.arange(len(self.user_ids)), self.user_ids),
+            'number_of_days': self.number_of_days_by_user,
+            'min_visits': self.min_visits_by_user,
+        })
         
-        print(f"Days available for each user:\n{self.days_available}")
+        if self.verbose:
+            print(f"Days available for each user:\n{self.days_available}")
     
     def spatial_join(self):
         """
-        Assigns each nighttime location to a census tract using a spatial join.
+        Assigns each nighttime location to a census tract by querying the tract STRtree.
+        Locations outside every tract are dropped. The result is read from the cache when available.
         
         Returns:
-            GeoDataFrame: The joined GeoDataFrame with census tract information.
+            DataFrame: The nighttime records with the GEOID of the tract containing them.
         """
-        geometry = [Point(xy) for xy in zip(self.night_data['orig_long'], self.night_data['orig_lat'])]
-        geo_night_data = gpd.GeoDataFrame(self.night_data, geometry=geometry)
-        geo_night_data.crs = self.tracts.crs
-        joined = gpd.sjoin(geo_night_data, self.tracts, how='left', predicate='within')
-        print(f"Joined GeoDataFrame contains {len(joined)} records.")
+        path = self.cache_path('.feather', self.input_file, self.shapefile, params=(self.projected_crs,))
+        if path is not None and os.path.exists(path):
+            joined = pd.read_feather(path)
+            # Keep user codes aligned with the loaded nighttime data
+            joined['user_ID'] = joined['user_ID'].astype(pd.CategoricalDtype(self.user_ids))
+            return joined
+        
+        if self.tracts is None:
+            self.load_tracts()
+        x, y = self.xy_transformer.transform(self.night_data['orig_long'].to_numpy(),
+                                             self.night_data['orig_lat'].to_numpy())
+
+        # Drop points outside the tract coverage grid; they would not match any tract anyway
+        mask = self.coverage_mask(x, y)
+        candidates = self.night_data[mask]
+        points = shapely.points(x[mask], y[mask])
+        idx_points, idx_tracts = self.tract_tree.query(points, predicate='within')
+        joined = candidates.iloc[idx_points].assign(
+            GEOID=pd.Categorical(self.tracts['GEOID'].to_numpy()[idx_tracts])
+        ).reset_index(drop=True)
+        if self.verbose:
+            print(f"Joined DataFrame contains {len(joined)} records.")
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            joined.to_feather(path)
         return joined
     
     def count_visits(self, joined):
@@ -104,14 +343,25 @@ class HomeLocationIdentifier:
         Counts the number of visits to each census tract during nighttime for each user.
         
         Args:
-            joined (GeoDataFrame): The joined GeoDataFrame with census tract information.
+            joined (DataFrame): The nighttime records with census tract information.
         
         Returns:
             DataFrame: DataFrame with visit counts per user and tract.
         """
-        visit_counts = joined.groupby(['user_ID', 'GEOID']).size().reset_index(name='visit_count')
-        visit_counts = visit_counts.merge(self.days_available, on='user_ID', how='left')
-        print(f"Visit counts:\n{visit_counts}")
+        geoids = joined['GEOID'].cat.categories
+        codes, pair_geoids, counts = _count_pairs(joined['user_ID'].cat.codes.to_numpy(np.int64),
+                                                  joined['GEOID'].cat.codes.to_numpy(np.int64), max(len(geoids), 1))
+        
+        # Gather per-user values by code instead of merging with days_available
+        visit_counts = pd.DataFrame({
+            'user_ID': pd.Categorical.from_codes(codes, self.user_ids),
+            'GEOID': pd.Categorical.from_codes(pair_geoids, geoids),
+            'visit_count': counts,
+            'number_of_days': self.number_of_days_by_user[codes],
+            'min_visits': self.min_visits_by_user[codes],
+        })
+        if self.verbose:
+            print(f"Visit counts:\n{visit_counts}")
         return visit_counts
     
     def filter_home_locations(self, visit_counts):
@@ -124,35 +374,43 @@ class HomeLocationIdentifier:
         Returns:
             DataFrame: DataFrame with the identified home locations.
         """
-        home_locations = visit_counts[visit_counts['visit_count'] >= visit_counts['min_visits']]
+        codes = visit_counts['user_ID'].cat.codes.to_numpy(np.int64)
+        
+        # Identify the tract with the most frequent visits among those meeting the minimum stay requirement
+        best_row = _home_per_user(codes, visit_counts['visit_count'].to_numpy(np.int64), self.min_visits_by_user,
+                                  len(self.user_ids))
         
         # Print users who have nighttime data but don't meet the minimum stay requirement
-        users_with_nighttime_data = visit_counts['user_ID'].unique()
-        users_with_home_locations = home_locations['user_ID'].unique()
-        users_without_home_locations = set(users_with_nighttime_data) - set(users_with_home_locations)
-        for user_id in users_without_home_locations:
-            print(f"User ID {user_id} has nighttime data but does not meet the minimum stay requirement.")
-        
-        # Identify the tract with the most frequent visits
-        home_locations = home_locations.loc[home_locations.groupby('user_ID')['visit_count'].idxmax()]
-        print(f"Home locations:\n{home_locations}")
+        if self.verbose:
+            users_with_nighttime_data = np.zeros(len(self.user_ids), dtype=bool)
+            users_with_nighttime_data[codes] = True
+            for user_id in self.user_ids[users_with_nighttime_data & (best_row < 0)]:
+                print(f"User ID {user_id} has nighttime data but does not meet the minimum stay requirement.")
+        
+        # Positional gather leaves an Int64 index of visit_counts rows; replace it with a RangeIndex
+        home_locations = visit_counts.iloc[best_row[best_row >= 0]].reset_index(drop=True)
+        if self.verbose:
+            print(f"Home locations:\n{home_locations}")
         return home_locations[['user_ID', 'GEOID', 'number_of_days', 'visit_count']]
     
     def save_results(self, home_locations):
         """
-        Saves the identified home locations to the output CSV file.
+        Saves the identified home locations to the output file, as zstd-compressed parquet when the file has
+        a .parquet extension and as CSV otherwise.
         
         Args:
             home_locations (DataFrame): DataFrame with the identified home locations.
         """
-        home_locations.to_csv(self.output_file, index=False)
+        if self.output_file.endswith('.parquet'):
+            home_locations.to_parquet(self.output_file, index=False, compression='zstd')
+        else:
+            home_locations.to_csv(self.output_file, index=False)
     
     def run(self):
         """
         Runs the entire home location identification process.
         """
         self.load_data()
-        self.filter_night_time_data()
         self.calculate_days_available()
         joined = self.spatial_join()
         visit_counts = self.count_visits(joined)
@@ -163,10 +421,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Identify home locations from user data.")
     parser.add_argument("input_file", help="Path to the input CSV file.")
     parser.add_argument("shapefile", help="Path to the census tract shapefile.")
-    parser.add_argument("output_file", help="Path to the output CSV file.")
+    parser.add_argument("output_file", help="Path to the output CSV (or .parquet) file.")
     parser.add_argument("--start_hour", type=int, default=22, help="Start hour for night time (default: 22).")
     parser.add_argument("--end_hour", type=int, default=6, help="End hour for night time (default: 6).")
+    parser.add_argument("--grid_cell_size", type=float, default=5000,
+                        help="Cell size in meters of the tract coverage prefilter grid (default: 5000).")
+    parser.add_argument("--chunksize", type=int, default=2_000_000,
+                        help="Number of input rows read per chunk (default: 2000000).")
+    parser.add_argument("--verbose", action="store_true", help="Print diagnostics for each step.")
+    parser.add_argument("--cache_dir", default=None,
+                        help="Directory for caching intermediate results (default: no caching).")
+    parser.add_argument("--projected_crs", default="EPSG:5070",
+                        help="Projected CRS used for the spatial join (default: EPSG:5070, lower 48 states).")
     args = parser.parse_args()
     
-    identifier = HomeLocationIdentifier(args.input_file, args.shapefile, args.output_file, args.start_hour, args.end_hour)
+    identifier = HomeLocationIdentifier(args.input_file, args.shapefile, args.output_file, args.start_hour, args.end_hour,
+                                        args.grid_cell_size, args.chunksize, args.verbose, args.cache_dir,
+                                        args.projected_crs)
     identifier.run()
\ No newline at end of file
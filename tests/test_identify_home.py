@@ -0,0 +1,217 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+pytest.importorskip("numba")
+
+from shapely.geometry import box
+
+from mawpy.utilities.identify_home import HomeLocationIdentifier, _count_pairs, _home_per_user
+
+UTILITIES_DIR = Path(__file__).parent.parent / "src" / "mawpy" / "utilities"
+NIGHT = 23 * 3600
+
+
+def _write_tracts(path):
+    tracts = gpd.GeoDataFrame(
+        {'GEOID': ['A1', 'B2']},
+        geometry=[box(-122.40, 47.60, -122.38, 47.62), box(-122.30, 47.60, -122.28, 47.62)],
+        crs='EPSG:4269',
+    )
+    tracts.to_file(path)
+    return str(path)
+
+
+def _write_records(path, records):
+    pd.DataFrame(records, columns=['unix_start_t', 'user_ID', 'orig_lat', 'orig_long']).to_csv(path, index=False)
+    return str(path)
+
+
+def _in_a1(user_id, day):
+    return day * 86400 + NIGHT, user_id, 47.61, -122.39
+
+
+def _in_b2(user_id, day):
+    return day * 86400 + NIGHT, user_id, 47.61, -122.29
+
+
+def _run(tmp_path, records, **kwargs):
+    output_file = tmp_path / 'home.csv'
+    HomeLocationIdentifier(_write_records(tmp_path / 'input.csv', records), _write_tracts(tmp_path / 'tracts.shp'),
+                           str(output_file), **kwargs).run()
+    return pd.read_csv(output_file, dtype={'user_ID': str})
+
+
+# A chunksize of 1 reads every record as its own chunk, most of them empty after the nighttime filter
+@pytest.mark.parametrize('chunksize', [2_000_000, 1])
+def test_reference_output(tmp_path, chunksize):
+    output_file = tmp_path / 'home.csv'
+    HomeLocationIdentifier(str(UTILITIES_DIR / '10_users.csv'),
+                           str(UTILITIES_DIR / 'cb_2022_us_tract_500k' / 'cb_2022_us_tract_500k.shp'),
+                           str(output_file), chunksize=chunksize).run()
+    assert output_file.read_bytes() == (UTILITIES_DIR / '10_users_home_locations.csv').read_bytes()
+
+
+def test_count_pairs():
+    users = np.array([1, 0, 1, 1, 0], dtype=np.int64)
+    items = np.array([2, 0, 2, 0, 0], dtype=np.int64)
+    pair_users, pair_items, counts = _count_pairs(users, items, 3)
+    np.testing.assert_array_equal(pair_users, [0, 1, 1])
+    np.testing.assert_array_equal(pair_items, [0, 0, 2])
+    np.testing.assert_array_equal(counts, [2, 1, 2])
+
+
+def test_count_pairs_empty():
+    empty = np.array([], dtype=np.int64)
+    pair_users, pair_items, counts = _count_pairs(empty, empty, 1)
+    assert len(pair_users) == len(pair_items) == len(counts) == 0
+
+
+def test_home_per_user():
+    users = np.array([0, 0, 0, 1, 1, 2], dtype=np.int64)
+    visits = np.array([3, 5, 5, 1, 1, 2], dtype=np.int64)
+    min_visits = np.array([2, 2, 0, 0], dtype=np.int64)
+    best_row = _home_per_user(users, visits, min_visits, 4)
+    # Ties keep the earliest row; user 1 misses min_visits; user 3 has no rows
+    np.testing.assert_array_equal(best_row, [1, -1, 5, -1])
+
+
+def test_home_per_user_zero_min_visits():
+    users = np.array([0, 0], dtype=np.int64)
+    visits = np.array([1, 1], dtype=np.int64)
+    np.testing.assert_array_equal(_home_per_user(users, visits, np.array([0], dtype=np.int64), 1), [0])
+
+
+def test_fewer_than_five_days(tmp_path):
+    home = _run(tmp_path, [_in_a1('a', 0), _in_a1('a', 1), _in_b2('a', 1)])
+    assert home.to_dict('records') == [{'user_ID': 'a', 'GEOID': 'A1', 'number_of_days': 2, 'visit_count': 2}]
+
+
+def test_min_visits_not_met(tmp_path):
+    # Six days need at least two visits to the same tract
+    records = [_in_a1('a', 0)] + [_in_b2('a', day) for day in range(1, 6)] + [_in_a1('b', 0)]
+    records += [_in_b2('b', 1)] + [(day * 86400 + NIGHT, 'b', 10.0, 10.0) for day in range(2, 6)]
+    home = _run(tmp_path, records)
+    assert home.to_dict('records') == [{'user_ID': 'a', 'GEOID': 'B2', 'number_of_days': 6, 'visit_count': 5}]
+
+def test_tie_keeps_lowest_geoid(tmp_path):
+    home = _run(tmp_path, [_in_b2('a', 0), _in_b2('a', 1), _in_a1('a', 2), _in_a1('a', 3)])
+    assert home['GEOID'].tolist() == ['A1']
+
+
+def test_points_outside_tracts(tmp_path):
+    records = [_in_a1('a', 0)] + [(day * 86400 + NIGHT, 'a', 10.0, 10.0) for day in range(1, 4)]
+    records += [(day * 86400 + NIGHT, 'b', 10.0, 10.0) for day in range(4)]
+    home = _run(tmp_path, records)
+    assert home.to_dict('records') == [{'user_ID': 'a', 'GEOID': 'A1', 'number_of_days': 4, 'visit_count': 1}]
+
+
+def test_daytime_records_ignored(tmp_path):
+    records = [_in_a1('a', 0), (86400 + 12 * 3600, 'a', 47.61, -122.29), (2 * 86400 + 12 * 3600, 'a', 47.61, -122.29)]
+    home = _run(tmp_path, records)
+    assert home.to_dict('records') == [{'user_ID': 'a', 'GEOID': 'A1', 'number_of_days': 1, 'visit_count': 1}]
+
+
+@pytest.mark.parametrize('user_ids', [('a', 'b'), ('10', '2')])
+def test_cache(tmp_path, user_ids):
+    pytest.importorskip("pyarrow")
+    records = [_in_a1(user_ids[0], day) for day in range(3)] + [_in_b2(user_ids[1], day) for day in range(2)]
+    input_file = _write_records(tmp_path / 'input.csv', records)
+    shapefile = _write_tracts(tmp_path / 'tracts.shp')
+    cache_dir = tmp_path / 'cache'
+    results = []
+    for run in range(2):
+        output_file = tmp_path / f'home_{run}.csv'
+        HomeLocationIdentifier(input_file, shapefile, str(output_file), cache_dir=str(cache_dir)).run()
+        results.append(pd.read_csv(output_file))
+        assert sorted(p.suffix for p in cache_dir.iterdir()) == ['.feather', '.parquet']
+    pd.testing.assert_frame_equal(results[0], results[1])
+    assert sorted(results[1]['GEOID']) == ['A1', 'B2']
+
+
+def test_cache_path_fields_separated(tmp_path):
+    # Without separators, 'x1' modified at 5.0 and 'x' modified at 15.0 both give the key 'x15.0'
+    (tmp_path / 'x1').touch()
+    (tmp_path / 'x').touch()
+    os.utime(tmp_path / 'x1', (5.0, 5.0))
+    os.utime(tmp_path / 'x', (15.0, 15.0))
+    identifier = HomeLocationIdentifier('', '', '', cache_dir=str(tmp_path))
+    paths = [identifier.cache_path('.parquet', str(tmp_path / name)) for name in ['x1', 'x']]
+    assert paths[0] != paths[1]
+
+
+def test_null_user_ids_ignored(tmp_path):
+    records = [_in_a1('a', day) for day in range(6)] + [_in_b2('b', day) for day in range(6)]
+    records += [(t, None, lat, long) for t, _, lat, long in records]
+    home = _run(tmp_path, records)
+    assert home.to_dict('records') == [{'user_ID': 'a', 'GEOID': 'A1', 'number_of_days': 6, 'visit_count': 6},
+                                       {'user_ID': 'b', 'GEOID': 'B2', 'number_of_days': 6, 'visit_count': 6}]
+
+
+def test_coverage_mask(tmp_path):
+    identifier = HomeLocationIdentifier('', _write_tracts(tmp_path / 'tracts.shp'), '')
+    identifier.load_tracts()
+    x, y = identifier.xy_transformer.transform(np.array([-122.39, -122.29, 10.0, np.nan]),
+                                               np.array([47.61, 47.61, 10.0, np.nan]))
+    np.testing.assert_array_equal(identifier.coverage_mask(x, y), [True, True, False, False])
+
+
+def test_days_available(tmp_path):
+    records = [_in_a1('a', day) for day in range(30)] + [_in_b2('b', day) for day in range(3)] + [_in_b2('b', 2)]
+    records += [(t, None, lat, long) for t, _, lat, long in records]
+    identifier = HomeLocationIdentifier(_write_records(tmp_path / 'input.csv', records),
+                                        _write_tracts(tmp_path / 'tracts.shp'), '')
+    identifier.load_data()
+    identifier.calculate_days_available()
+    # 30 days is more than 21, so min_visits is the number of weeks rounded up; 3 days is below the table
+    days_available = identifier.days_available[['user_ID', 'number_of_days', 'min_visits']]
+    assert days_available.astype({'user_ID': str}).to_dict('records') == [
+        {'user_ID': 'a', 'number_of_days': 30, 'min_visits': 5},
+        {'user_ID': 'b', 'number_of_days': 3, 'min_visits': 0},
+    ]
+
+
+@pytest.mark.parametrize('chunksize', [2_000_000, 1])
+def test_numeric_user_ids(tmp_path, chunksize):
+    records = [_in_a1(user_id, day) for user_id in ['10', '2', '007'] for day in range(2)]
+    output_file = tmp_path / 'home.csv'
+    HomeLocationIdentifier(_write_records(tmp_path / 'input.csv', records), _write_tracts(tmp_path / 'tracts.shp'),
+                           str(output_file), chunksize=chunksize).run()
+    assert pd.read_csv(output_file)['user_ID'].tolist() == [2, 7, 10]
+
+
+def test_parquet_output(tmp_path):
+    pytest.importorskip("pyarrow")
+    records = [_in_a1('a', day) for day in range(3)]
+    output_file = tmp_path / 'home.parquet'
+    HomeLocationIdentifier(_write_records(tmp_path / 'input.csv', records), _write_tracts(tmp_path / 'tracts.shp'),
+                           str(output_file)).run()
+    home = pd.read_parquet(output_file).astype({'user_ID': str, 'GEOID': str})
+    assert home.to_dict('records') == [{'user_ID': 'a', 'GEOID': 'A1', 'number_of_days': 3, 'visit_count': 3}]
+
+
+def test_projected_crs(tmp_path):
+    records = [_in_a1('a', day) for day in range(2)] + [_in_b2('b', day) for day in range(2)]
+    home = _run(tmp_path, records, projected_crs='EPSG:32610')
+    assert home['GEOID'].tolist() == ['A1', 'B2']
+
+
+def test_projected_crs_only_keys_join_cache(tmp_path):
+    pytest.importorskip("pyarrow")
+    input_file = _write_records(tmp_path / 'input.csv', [_in_a1('a', day) for day in range(2)])
+    shapefile = _write_tracts(tmp_path / 'tracts.shp')
+    cache_dir = tmp_path / 'cache'
+    for projected_crs in ['EPSG:5070', 'EPSG:32610']:
+        HomeLocationIdentifier(input_file, shapefile, str(tmp_path / 'home.csv'), cache_dir=str(cache_dir),
+                               projected_crs=projected_crs).run()
+    assert sorted(p.suffix for p in cache_dir.iterdir()) == ['.feather', '.feather', '.parquet']
+
+def test_shapefile_without_crs(tmp_path):
+    shapefile = _write_tracts(tmp_path / 'tracts.shp')
+    (tmp_path / 'tracts.prj').unlink()
+    with pytest.raises(ValueError, match="has no CRS"):
+        HomeLocationIdentifier('', shapefile, '').load_tracts()